@@ -6,12 +6,14 @@ Last Changed:  24 November 2014
 """
 
 import threading
+import Queue
 import collections
 import time
 import datetime
 import math
 import random
 import os.path
+import tempfile
 from PIL import Image
 
 import logging
@@ -71,6 +73,7 @@ class Camera(object):
         self.logger = logging.getLogger(self.name)
         self.controlfocus = controlfocus
         self.in_preview = False
+        self.focusposition = None
         gp.check_result(gp.gp_camera_init(self.camera, self.context))
 
     def log(self, msg, level = logging.INFO):
@@ -81,14 +84,23 @@ class Camera(object):
         gp.check_result(gp.gp_camera_exit(self.camera, self.context))
 
     def retry_until_not_busy(self, cmd):
+        """Run cmd, retrying while the camera is busy.
+
+        Returns the time at which the camera stopped reporting busy, i.e.
+        when the last attempt that failed with GP_ERROR_CAMERA_BUSY returned,
+        or None if the camera wasn't busy.
+        """
+        idle_since = None
         while True:
             try:
                 cmd()
                 break
             except gp.GPhoto2Error as e:
                 if e.code == gp.GP_ERROR_CAMERA_BUSY:
+                    idle_since = time.time()
                     continue
                 raise
+        return idle_since
 
     def _get_widget(self, config_name):
         config = gp.check_result(
@@ -193,38 +205,99 @@ class Camera(object):
 
     def _cf_to_img(self, cf):
         # TODO: Find a way to load image directly (w/o saving)
-        tempfilename = random_nonexisting_filename()
-        cf.save(tempfilename)
-        img = Image.open(tempfilename)
-        os.remove(tempfilename)
+        # Use mkstemp as this runs in several evaluator threads at once
+        fd, tempfilename = tempfile.mkstemp(prefix = ".ICE_temp_")
+        os.close(fd)
+        try:
+            cf.save(tempfilename)
+            img = Image.open(tempfilename)
+            img.load()
+        finally:
+            os.remove(tempfilename)
         return img
 
-    def focus(self, focusfunc = None):
+    def _evaluate_previews(self, focusfunc, previews, focuslist):
+        """Worker: decode previews and evaluate focusfunc on them.
+
+        Runs alongside focus() so that the next lens step and preview capture
+        don't have to wait for the (slow) image decoding and metric
+        evaluation. A None item on the previews queue stops the worker.
+        """
+        while True:
+            item = previews.get()
+            if item is None:
+                return
+            pos, cf = item
+            try:
+                focusval = focusfunc(self._cf_to_img(cf))
+            except Exception as e:
+                self.log("Could not evaluate preview at {}: {}".format(pos, e),
+                         logging.ERROR)
+                focusval = None
+            focuslist.append((pos, focusval))
+            self.log("Focus value at {}: {}".format(pos, focusval))
+
+    def focus(self, focusfunc, steps = 25, stepsize = 200):
+        """Sweep the lens and move it to the position where focusfunc, which
+        maps a preview image to a focus value, is highest.
+
+        Returns the measured focus curve as a list of (position, focus value)
+        tuples, or None if focusing failed. The final position is stored in
+        self.focusposition.
+        """
         # TODO: Implement "circa focus distance" and range within to focus
         self.log("Focusing")
         if not self.controlfocus:
             self.log(("Cannot focus camera. Set Camera.controlfocus = True and"
                       "switch lens to 'A' or 'A/M' mode"), logging.ERROR)
             return
+        self.focusposition = None
         self.enter_preview()
-        # Go to end of focus range
-        while True:
+        try:
+            # Go to end of focus range
+            while True:
+                try:
+                    self._focusstep(-10000)
+                except gp.GPhoto2Error as e:
+                    if e.code == -113:
+                        # At focus limit
+                        break
+                    else:
+                        raise
+            focuslist = list()
+            previews = Queue.Queue()
+            evaluator = threading.Thread(
+                    target = self._evaluate_previews,
+                    args = (focusfunc, previews, focuslist))
+            evaluator.start()
+            pos = 0
             try:
-                self._focusstep(-10000)
-            except gp.GPhoto2Error as e:
-                if e.code == -113:
-                    # At focus limit
-                    break
-                else:
-                    raise
-        focuslist = list()
-        for i in range(25):
-            self._focusstep(200)
-            focusval = focusfunc(self._cf_to_img(self.capture_preview()))
-            focuslist.append((i*200, focusval))
-            print "{} {}".format(*focuslist[-1])
-        self.exit_preview()
-        # TODO: Examine around max with real images, move to max
+                for i in range(steps):
+                    try:
+                        self._focusstep(stepsize)
+                    except gp.GPhoto2Error as e:
+                        if e.code == -113:
+                            # At other end of focus range, end sweep here
+                            break
+                        raise
+                    pos += stepsize
+                    previews.put((pos, self.capture_preview()))
+            finally:
+                previews.put(None)
+                evaluator.join()
+            valid = [ (p, val) for p, val in focuslist if val is not None ]
+            if not valid:
+                self.log("No valid focus values, could not focus",
+                         logging.ERROR)
+                return None
+            # Move back to the position with the best focus value
+            bestpos = max(valid, key = lambda pv: pv[1])[0]
+            if bestpos != pos:
+                self._focusstep(bestpos - pos)
+            self.focusposition = bestpos
+        finally:
+            self.exit_preview()
+        # TODO: Examine around max with real images
         return focuslist
 
     def autofocus(self, contrast = False):
@@ -306,6 +379,88 @@ class WorkUnit(object):
         raise NotImplementedError
 
 
+class BufferModel(object):
+    """Rough model of a camera's internal buffer and SD card write rate.
+
+    Shots go into the buffer at the shooting speed and are drained onto the
+    card at writerate (shots per second). When the buffer is full, the camera
+    can only shoot as fast as it writes, and it reports GP_ERROR_CAMERA_BUSY
+    on configuration changes until the buffer is empty. All times are in
+    seconds.
+    """
+
+    # Weight of a new observation when recalibrating the write rate
+    SMOOTHING = .3
+
+    def __init__(self, size = 20, writerate = 2.):
+        self.size = size
+        self.writerate = float(writerate)
+        self.occupancy = 0.
+        self.lastupdate = None
+        # Whether the buffer is predicted to have filled up since it was last
+        # empty, and when and with how many shots it started draining after
+        # the last shots. Used for calibration.
+        self.saturated = False
+        self.drain_start = None
+        self.drain_shots = 0.
+
+    def copy(self):
+        return BufferModel(self.size, self.writerate)
+
+    def _drain(self, t):
+        if self.lastupdate is not None and t > self.lastupdate:
+            self.occupancy = max(0., self.occupancy
+                                     - self.writerate * (t - self.lastupdate))
+            self.lastupdate = t
+        if self.occupancy == 0:
+            self.saturated = False
+
+    def free_at(self):
+        """Time at which the buffer is predicted to be empty, or None if
+        nothing has been shot yet."""
+        if self.lastupdate is None:
+            return None
+        return self.lastupdate + self.occupancy / self.writerate
+
+    def add(self, t, nr_of_images, fps = 0):
+        """Add nr_of_images shot at fps, starting at t.
+
+        Returns the number of seconds the shots are predicted to be delayed
+        because the buffer is full.
+        """
+        self._drain(t)
+        duration = (nr_of_images - 1) / float(fps) if fps else 0.
+        peak = self.occupancy + nr_of_images - self.writerate * duration
+        stall = max(0., peak - self.size) / self.writerate
+        self.occupancy = max(0., min(peak, self.size))
+        self.lastupdate = t + duration + stall
+        self.saturated = self.saturated or peak >= self.size
+        self.drain_start = self.lastupdate
+        self.drain_shots = self.occupancy
+        return stall
+
+    def observe_idle(self, t, busy = False):
+        """Calibrate from the camera being idle at t.
+
+        If busy is True, the camera was busy until t, so it finished writing
+        at t. Otherwise it was already idle when we asked at t, so it
+        finished writing at t at the latest.
+
+        The write rate is only recalibrated if the buffer was predicted to be
+        full, as otherwise the shooting rate rather than the write rate
+        determines when the camera becomes idle.
+        """
+        if (self.saturated and self.drain_shots > 0
+                and t > self.drain_start):
+            observed = self.drain_shots / (t - self.drain_start)
+            # If the camera wasn't busy, observed is only a lower bound
+            if busy or observed > self.writerate:
+                self.writerate += self.SMOOTHING * (observed - self.writerate)
+        self.occupancy = 0.
+        self.lastupdate = t
+        self.saturated = False
+
+
 class Job(threading.Thread):
 
     WAITING = 0
@@ -316,12 +471,24 @@ class Job(threading.Thread):
     DOWNLOADED = 5
     STOPPED = 6
 
-    def __init__(self, camera, timelist):
+    # Seconds before a work unit's trigger time at which it is set up
+    SETUP_LEAD = .15
+    # Fraction of the predicted time to empty a full buffer by which setup is
+    # brought forward, so we can tell whether the card writes faster than
+    # predicted
+    PROBE_LEAD = .2
+
+    def __init__(self, camera, timelist, buffersize = 20, writerate = 2.):
         super(Job, self).__init__()
         self.camera = camera
         self.timelist = timelist
         self.inittime = datetime.datetime.now()
+        self.buffer = BufferModel(buffersize, writerate)
+        # Held while talking to the camera, so that others (e.g.
+        # JobManager.focus_all()) can wait until we're done
+        self.camera_lock = threading.Lock()
         self.work_units = self.list_to_units(self.timelist)
+        self.check_schedule()
         self.work_units_abstime = None
         self.status = self.WAITING
         self.statuschange = threading.Event()
@@ -395,6 +562,57 @@ class Job(threading.Thread):
                                     )) )
         return units
 
+    @staticmethod
+    def _wu_fps(wu):
+        """Best guess of the fps a work unit will actually shoot at."""
+        if wu.real_fps is not None:
+            return wu.real_fps
+        return min(wu.wanted_fps, 4.5)
+
+    def check_schedule(self):
+        """Simulate the camera buffer for our schedule, warn about stalls.
+
+        Returns a list of (time, work unit, delay) tuples for all work units
+        that are predicted to be late, with time and delay in ms.
+
+        The camera's 'availableshots' is only used to check whether the card
+        can hold all pictures; it does not tell us anything about the buffer
+        and is not used to calibrate the model.
+        """
+        sim = self.buffer.copy()
+        stalls = list()
+        for dt, wu in self.work_units:
+            t = dt / 1000.
+            # Camera needs to be idle to be set up
+            free = sim.free_at()
+            delay = 0.
+            if free is not None:
+                delay = max(0., free - (t - self.SETUP_LEAD))
+            delay += sim.add(t + delay, wu.nr_of_images, self._wu_fps(wu))
+            if delay > 0:
+                stalls.append((dt, wu, delay * 1000))
+        if stalls:
+            self.camera.log(("Schedule not feasible with buffer size {} and "
+                             "write rate {:.2f} shots/s: {} work units "
+                             "predicted late, first at {} ms, by up to {:.0f} "
+                             "ms").format(
+                                sim.size, sim.writerate, len(stalls),
+                                stalls[0][0], max(s[2] for s in stalls)),
+                            logging.WARNING)
+        # Check if the card can take all the pictures
+        try:
+            available = int(self.camera.get_config('availableshots'))
+        except (gp.GPhoto2Error, TypeError, ValueError):
+            self.camera.log(("Number of available shots unknown, not checking "
+                             "card capacity"), logging.DEBUG)
+            available = None
+        needed = sum(wu.nr_of_images for dt, wu in self.work_units)
+        if available is not None and needed > available:
+            self.camera.log(("Schedule needs {} shots but card only has space "
+                             "for {}").format(needed, available),
+                            logging.WARNING)
+        return stalls
+
     def shift_units(self, timedelta):
         self.work_units_abstime = collections.deque(
                 [ (dt + timedelta, wu)
@@ -403,6 +621,9 @@ class Job(threading.Thread):
     def run(self):
         # Our simple state machine
         while True:
+            # Clear before looking at the status so that _running() can be
+            # interrupted by any status change from here on
+            self.statuschange.clear()
             if self.status == self.RUNNING:
                 self._running()
             elif self.status == self.STOPPED:
@@ -417,24 +638,81 @@ class Job(threading.Thread):
             # Done :)
             self._set_status(self.ALL_TRIGGERED)
             return
-        # Wait until 150 ms before this_time, return on statuschange
+        if this_wu.status != WorkUnit.SETUP:
+            # Not set up yet (we may get here again e.g. after a pause)
+            if not self._setup(this_time, this_wu):
+                return
+        # Setup may have happened long before this_time, wait until shortly
+        # before it, return on statuschange
         try:
             if self.statuschange.wait(
-                  (this_time - datetime.datetime.now()).total_seconds() - .15):
+                  (this_time - datetime.datetime.now()).total_seconds()
+                  - self.SETUP_LEAD):
                 return
         except IOError:
             # TODO: Behind schedule!
             pass
-        self.camera.retry_until_not_busy(this_wu.setup)
+        with self.camera_lock:
+            if self.status != self.RUNNING:
+                return
+            try:
+                time.sleep(
+                    (this_time - datetime.datetime.now()).total_seconds())
+            except IOError:
+                # TODO: Behind schedule!
+                pass
+            self.camera.retry_until_not_busy(this_wu.trigger)
+            stall = self.buffer.add(time.time(), this_wu.nr_of_images,
+                                    self._wu_fps(this_wu))
+        if stall > 0:
+            self.camera.log(("Buffer predicted to fill up, shots delayed by "
+                             "{:.2f} s").format(stall), logging.WARNING)
+        # TODO: Check for camera events?
+        # Remove the WU we just processed from queue
+        self.work_units_abstime.popleft()
+
+    def _setup(self, this_time, this_wu):
+        """Set up this_wu as soon as the camera is predicted to be idle.
+
+        Returns False if the status changed before this_wu was set up.
+        """
+        setup_time = this_time - datetime.timedelta(seconds = self.SETUP_LEAD)
+        free = self.buffer.free_at()
+        if free is not None:
+            free_time = datetime.datetime.fromtimestamp(free)
+            if free_time > setup_time:
+                self.camera.log(("Camera predicted to be busy {:.2f} s past "
+                                 "setup time").format(
+                                    (free_time - setup_time).total_seconds()),
+                                logging.WARNING)
+            # Set up as soon as the camera has finished writing, so it is
+            # idle when this WU is due
+            setup_time = free_time
+            if self.buffer.saturated:
+                # Ask a bit earlier: If the camera is still busy, we learn
+                # exactly when it finished writing, and if it isn't, we learn
+                # that it writes faster than predicted
+                setup_time -= datetime.timedelta(seconds = self.PROBE_LEAD
+                                        * (free - self.buffer.drain_start))
+        # Wait until setup_time, return on statuschange
         try:
-            time.sleep((this_time - datetime.datetime.now()).total_seconds())
+            if self.statuschange.wait(
+                  (setup_time - datetime.datetime.now()).total_seconds()):
+                return False
         except IOError:
             # TODO: Behind schedule!
             pass
-        self.camera.retry_until_not_busy(this_wu.trigger)
-        # TODO: Check for camera events?
-        # Remove the WU we just processed from queue
-        self.work_units_abstime.popleft()
+        with self.camera_lock:
+            if self.status != self.RUNNING:
+                # Paused or stopped while waiting for the lock
+                return False
+            asked = time.time()
+            idle_since = self.camera.retry_until_not_busy(this_wu.setup)
+        if idle_since is None:
+            self.buffer.observe_idle(asked, busy = False)
+        else:
+            self.buffer.observe_idle(idle_since, busy = True)
+        return True
 
     def _wait_for_statuschange(self):
         self.statuschange.wait()
@@ -476,10 +754,12 @@ class JobManager(object):
     DOWNLOADED = 4
     STOPPED = 5
 
-    def __init__(self, cameras, timelists):
+    def __init__(self, cameras, timelists, **kwargs):
+        """Additional keyword arguments (e.g. buffersize, writerate) are
+        passed on to the jobs."""
         if len(cameras) != len(timelists):
             raise ValueError("Different number of cameras and timelists")
-        self.jobs = [ Job(c, t) for c, t in zip(cameras, timelists) ]
+        self.jobs = [ Job(c, t, **kwargs) for c, t in zip(cameras, timelists) ]
         self.status = self.WAITING
 
     def capture_all(self):
@@ -503,3 +783,56 @@ class JobManager(object):
             j.stop()
         self.status = self.STOPPED
 
+    def focus_all(self, focusfunc, max_workers = 4, **kwargs):
+        """Run Camera.focus() on all cameras concurrently.
+
+        At most max_workers cameras are focused at the same time. Additional
+        keyword arguments are passed on to Camera.focus().
+
+        The jobs must not be using the cameras while they focus: Every job
+        has to be waiting, paused, or done triggering (e.g. call pause_all()
+        first when refocusing between time-lapse intervals), otherwise a
+        RuntimeError is raised. A job that was paused while it was about to
+        trigger finishes doing so before its camera is focused, and it will
+        not touch the camera until focusing is done.
+
+        Returns a dict mapping camera names to (focuslist, focusposition)
+        tuples, where focuslist is the measured focus curve and focusposition
+        the lens position (relative to the near focus limit) the camera ended
+        up at. Cameras that failed to focus map to (None, None).
+        """
+        idle = (Job.WAITING, Job.PAUSED, Job.ALL_TRIGGERED)
+        if any(j.status not in idle for j in self.jobs):
+            raise RuntimeError("Cannot focus while jobs are running, pause "
+                               "them first")
+        jobs = Queue.Queue()
+        for j in self.jobs:
+            jobs.put(j)
+        results = dict()
+
+        def worker():
+            while True:
+                try:
+                    job = jobs.get_nowait()
+                except Queue.Empty:
+                    return
+                cam = job.camera
+                try:
+                    with job.camera_lock:
+                        focuslist = cam.focus(focusfunc, **kwargs)
+                    if focuslist is None:
+                        results[cam.name] = (None, None)
+                    else:
+                        results[cam.name] = (focuslist, cam.focusposition)
+                except Exception as e:
+                    cam.log("Focusing failed: {}".format(e), logging.ERROR)
+                    results[cam.name] = (None, None)
+
+        workers = [ threading.Thread(target = worker)
+                    for i in range(min(max_workers, len(self.jobs))) ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return results
+
@@ -10,12 +10,14 @@ class DummyCamera(object):
     def __init__(self, name = "Dummy", controlfocus = False, **kwargs):
         self.name = name
         self.logger = logging.getLogger(self.name)
+        self.focusposition = None
 
     def release(self):
         self.log("Released")
 
     def retry_until_not_busy(self, cmd):
         cmd()
+        return None
 
     def _get_widget(self, config_name):
         self.log("Requested widget: {}".format(config_name))
@@ -75,8 +77,9 @@ class DummyCamera(object):
             self.enter_preview()
         self.log("Focus step: {}".format(step))
 
-    def focus(self, focusfunc = None):
+    def focus(self, focusfunc, steps = 25, stepsize = 200):
         self.log("Focusing")
+        self.focusposition = 0
         return []
 
     def autofocus(self, contrast = False):
@@ -0,0 +1,147 @@
+import collections
+import datetime
+import time
+import unittest
+
+import gphoto2 as gp
+
+from ice import BufferModel, Camera, Job, WorkUnit
+from ice.debugging import DummyCamera
+
+
+class CardCamera(Camera):
+    """Camera with a one-shot buffer that is written to card at writerate.
+
+    Like real cameras, it reports busy on configuration changes until it has
+    finished writing.
+    """
+
+    def __init__(self, writerate):
+        self.name = "Card"
+        self.controlfocus = False
+        self.in_preview = False
+        self.focusposition = None
+        self.writerate = writerate
+        self.busy_until = 0.
+        self.configs_set = 0
+        self.triggered = 0
+
+    def log(self, msg, level = None):
+        pass
+
+    def get_config(self, config_name):
+        return None
+
+    def set_config(self, config_name, value):
+        if time.time() < self.busy_until:
+            raise gp.GPhoto2Error(gp.GP_ERROR_CAMERA_BUSY)
+        self.configs_set += 1
+
+    def trigger(self):
+        self.busy_until = time.time() + 1. / self.writerate
+        self.triggered += 1
+
+
+class BufferModelTest(unittest.TestCase):
+
+    def test_no_stall_when_buffer_not_full(self):
+        b = BufferModel(size = 20, writerate = 2.)
+        self.assertEqual(b.add(0, 10, 4), 0)
+        self.assertFalse(b.saturated)
+
+    def test_stall_when_buffer_full(self):
+        b = BufferModel(size = 20, writerate = 2.)
+        # 50 shots in ~11 s: 28 shots left to write when done, 8 too many
+        self.assertAlmostEqual(b.add(0, 50, 4.5), 4.11, places = 2)
+        self.assertTrue(b.saturated)
+        self.assertAlmostEqual(b.free_at(), 25.)
+
+    def test_no_calibration_if_not_saturated(self):
+        # 10 shots at 1 fps never fill a buffer that's drained at 2 shots/s,
+        # so being busy afterwards says nothing about the write rate
+        b = BufferModel(size = 20, writerate = 2.)
+        b.add(0, 10, 1)
+        b.observe_idle(10., busy = True)
+        self.assertEqual(b.writerate, 2.)
+
+    def test_calibrate_slower_card(self):
+        b = BufferModel(size = 20, writerate = 2.)
+        b.add(0, 50, 4.5)
+        # Predicted to be done writing at 25 s, but was still busy until 35 s
+        b.observe_idle(35., busy = True)
+        self.assertLess(b.writerate, 2.)
+        self.assertGreater(b.writerate, 20. / 30.)
+
+    def test_calibrate_faster_card(self):
+        b = BufferModel(size = 20, writerate = 2.)
+        b.add(0, 50, 4.5)
+        b.observe_idle(20., busy = False)
+        self.assertGreater(b.writerate, 2.)
+
+    def test_no_calibration_when_idle_late(self):
+        b = BufferModel(size = 20, writerate = 2.)
+        b.add(0, 50, 4.5)
+        b.observe_idle(100., busy = False)
+        self.assertEqual(b.writerate, 2.)
+        self.assertEqual(b.free_at(), 100.)
+
+
+class CheckScheduleTest(unittest.TestCase):
+
+    def make_job(self, timelist):
+        job = Job(DummyCamera(), timelist, buffersize = 20, writerate = 2.)
+        self.addCleanup(job.stop)
+        return job
+
+    def test_back_to_back_bursts_are_late(self):
+        burst = range(0, 5000, 250)
+        job = self.make_job(burst + [ 6000 + t for t in burst ])
+        stalls = job.check_schedule()
+        self.assertEqual(len(stalls), 1)
+        self.assertEqual(stalls[0][0], 6000)
+        self.assertGreater(stalls[0][2], 0)
+
+    def test_sparse_schedule_is_feasible(self):
+        job = self.make_job(range(0, 10 * 60000, 60000))
+        self.assertEqual(job.check_schedule(), [])
+
+
+class RunningCalibrationTest(unittest.TestCase):
+
+    def make_job(self, camera, writerate, nr_of_units, interval = .08):
+        job = Job(camera, [0], buffersize = 1, writerate = writerate)
+        self.addCleanup(job.stop)
+        # We call _running() ourselves instead of letting the thread do it
+        job.status = Job.RUNNING
+        start = datetime.datetime.now() + datetime.timedelta(seconds = .05)
+        job.work_units_abstime = collections.deque(
+                [ (start + datetime.timedelta(seconds = i * interval),
+                   WorkUnit(camera, 1, 0))
+                  for i in range(nr_of_units) ])
+        return job
+
+    def run_units(self, job):
+        while job.work_units_abstime:
+            job._running()
+
+    def test_converges_to_slower_card(self):
+        job = self.make_job(CardCamera(writerate = 20.), 40., 30)
+        self.run_units(job)
+        self.assertAlmostEqual(job.buffer.writerate, 20., delta = 3.)
+
+    def test_converges_to_faster_card(self):
+        job = self.make_job(CardCamera(writerate = 40.), 20., 30)
+        self.run_units(job)
+        self.assertAlmostEqual(job.buffer.writerate, 40., delta = 6.)
+
+    def test_no_repeated_setup(self):
+        camera = CardCamera(writerate = 40.)
+        job = self.make_job(camera, 40., 1)
+        job.work_units_abstime[0][1].status = WorkUnit.SETUP
+        self.run_units(job)
+        self.assertEqual(camera.configs_set, 0)
+        self.assertEqual(camera.triggered, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
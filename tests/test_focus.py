@@ -0,0 +1,145 @@
+import threading
+import time
+import unittest
+
+import gphoto2 as gp
+
+from ice import Camera, Job, JobManager
+
+
+class FocusCamera(Camera):
+    """Camera with a simulated lens that can be driven from 0 to limit."""
+
+    def __init__(self, name = "Focus", limit = 10000, controlfocus = True,
+                 delay = 0, concurrency = None):
+        self.name = name
+        self.limit = limit
+        self.controlfocus = controlfocus
+        self.delay = delay
+        self.concurrency = concurrency
+        self.in_preview = False
+        self.focusposition = None
+        self.pos = 0
+
+    def log(self, msg, level = None):
+        pass
+
+    def get_config(self, config_name):
+        return None
+
+    def set_config(self, config_name, value):
+        pass
+
+    def _focusstep(self, step):
+        if not self.in_preview:
+            self.enter_preview()
+        newpos = self.pos + step
+        if newpos < 0 and self.pos == 0 or newpos > self.limit:
+            raise gp.GPhoto2Error(-113)
+        self.pos = max(0, newpos)
+
+    def capture_preview(self, save_to = None):
+        if self.concurrency is not None:
+            self.concurrency.enter()
+        time.sleep(self.delay)
+        if self.concurrency is not None:
+            self.concurrency.leave()
+        return self.pos
+
+    def _cf_to_img(self, cf):
+        # Our "previews" are simply the lens position
+        return cf
+
+
+class Concurrency(object):
+    """Count how many cameras capture previews at the same time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.max = 0
+
+    def enter(self):
+        with self.lock:
+            self.current += 1
+            self.max = max(self.max, self.current)
+
+    def leave(self):
+        with self.lock:
+            self.current -= 1
+
+
+def peak_at(bestpos):
+    return lambda pos: -abs(pos - bestpos)
+
+
+class CameraFocusTest(unittest.TestCase):
+
+    def test_moves_to_best_position(self):
+        cam = FocusCamera()
+        focuslist = cam.focus(peak_at(1200), steps = 10, stepsize = 200)
+        self.assertEqual([ p for p, v in focuslist ],
+                         range(200, 2200, 200))
+        self.assertEqual(cam.focusposition, 1200)
+        self.assertEqual(cam.pos, 1200)
+        self.assertFalse(cam.in_preview)
+
+    def test_sweep_ends_at_focus_limit(self):
+        cam = FocusCamera(limit = 1000)
+        focuslist = cam.focus(peak_at(600), steps = 25, stepsize = 200)
+        self.assertEqual([ p for p, v in focuslist ],
+                         range(200, 1200, 200))
+        self.assertEqual(cam.focusposition, 600)
+        self.assertEqual(cam.pos, 600)
+        self.assertFalse(cam.in_preview)
+
+    def test_no_valid_focus_values(self):
+        cam = FocusCamera()
+        self.assertIsNone(cam.focus(lambda img: None, steps = 5))
+        self.assertIsNone(cam.focusposition)
+        self.assertFalse(cam.in_preview)
+
+
+class FocusAllTest(unittest.TestCase):
+
+    def make_jm(self, cameras):
+        jm = JobManager(cameras, [[0]] * len(cameras))
+        self.addCleanup(jm.stop_all)
+        return jm
+
+    def test_focus_all(self):
+        jm = self.make_jm([ FocusCamera("C0"), FocusCamera("C1") ])
+        results = jm.focus_all(peak_at(400), steps = 5, stepsize = 200)
+        self.assertEqual(sorted(results), ["C0", "C1"])
+        for focuslist, focusposition in results.values():
+            self.assertEqual(len(focuslist), 5)
+            self.assertEqual(focusposition, 400)
+
+    def test_failing_cameras(self):
+        broken = FocusCamera("broken")
+        broken.capture_preview = lambda save_to = None: 1 / 0
+        cameras = [ broken, FocusCamera("nocontrol", controlfocus = False),
+                    FocusCamera("ok") ]
+        results = self.make_jm(cameras).focus_all(peak_at(400), steps = 5)
+        self.assertEqual(results["broken"], (None, None))
+        self.assertEqual(results["nocontrol"], (None, None))
+        self.assertEqual(results["ok"][1], 400)
+
+    def test_max_workers(self):
+        concurrency = Concurrency()
+        cameras = [ FocusCamera("C{}".format(i), delay = .01,
+                                concurrency = concurrency)
+                    for i in range(5) ]
+        results = self.make_jm(cameras).focus_all(peak_at(400), max_workers = 2,
+                                                  steps = 5)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(concurrency.max, 2)
+
+    def test_refuses_while_running(self):
+        jm = self.make_jm([ FocusCamera("C0") ])
+        jm.jobs[0].status = Job.RUNNING
+        self.assertRaises(RuntimeError, jm.focus_all, peak_at(400))
+
+
+if __name__ == '__main__':
+    unittest.main()